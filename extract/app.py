@@ -1,8 +1,9 @@
 import os
-import boto3
-import json
-import requests
-import datetime
+import botocore.session
+from botocore.config import Config
+import orjson
+import re
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import unquote_plus
 from blood_test import morphology
 import logging
@@ -10,155 +11,388 @@ import logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Create the AWS session and clients once per container so warm invocations
+# reuse them and the credential provider chain runs exactly once.
+# Keep-alive lets the HTTPS connections persist across warm invocations too.
+BOTO_CFG = Config(
+    tcp_keepalive=True,
+    retries={"max_attempts": 3, "mode": "adaptive"},
+    connect_timeout=2,
+    read_timeout=30,
+)
+BOTO_SESSION = botocore.session.Session()
+TEXTRACT_CLIENT = BOTO_SESSION.create_client("textract", config=BOTO_CFG)
+DDB_CLIENT = BOTO_SESSION.create_client("dynamodb", config=BOTO_CFG)
+
+# DynamoDB table caching inserted payloads by object version/etag, so
+# duplicated s3:ObjectCreated events neither re-run the paid Textract analysis
+# nor insert a duplicate Airtable row. Caching is disabled when the table is
+# not configured.
+CACHE_TABLE = os.getenv("CACHE_TABLE")
+
+# Shared HTTP session for the Airtable inserts, created lazily on the first
+# insert so cold starts that never reach the Airtable path skip the requests
+# import (see _get_airtable_session)
+AIRTABLE_SESSION = None
+
+# Resolve the Airtable settings once per container - they never change
+_ACCESS_TOKEN = os.getenv("AIRTABLE_ACCESS_KEY")
+_BASE_ID = os.getenv("BASE_ID")
+_TABLE_ID = os.getenv("TABLE_ID")
+AIRTABLE_URL = f"https://api.airtable.com/v0/{_BASE_ID}/{_TABLE_ID}"
+AIRTABLE_HEADERS = {
+    "Authorization": f"Bearer {_ACCESS_TOKEN}",
+    "Content-Type": "application/json",
+}
+
+# Tests whose extracted value may carry a trailing unit to trim
+_PCT_TESTS = frozenset({"BASO", "NEU%", "LYMPH%", "MON%", "EOS%"})
+
+# Invalid characters/units marking where an extracted value ends
+_TRIM_RE = re.compile(r"[\^/%]|fl|pg")
+
+# Translation table turning decimal commas into dots
+_DEC = str.maketrans({",": "."})
+
+# Notification channel for the async Textract flow
+SNS_TOPIC_ARN = os.getenv("TEXTRACT_SNS_TOPIC_ARN")
+TEXTRACT_ROLE_ARN = os.getenv("TEXTRACT_ROLE_ARN")
+
+# Thread pool for overlapping independent network I/O within one invocation
+EXECUTOR = ThreadPoolExecutor(max_workers=4)
+
 
 def lambda_handler(event, context):
     """Return blood result from the file uploaded to the S3 bucket"""
     # Return details of the file uploded to the S3 bucket
     bucket = event["Records"][0]["s3"]["bucket"]["name"]
     key = unquote_plus(event["Records"][0]["s3"]["object"]["key"], encoding="utf-8")
-    version = get_version(bucket=bucket, key=key)
+    version = event["Records"][0]["s3"]["object"].get("versionId")
+
+    # Return the cached payload when a duplicated S3 event re-delivers an
+    # already processed and inserted object
+    cache_key = version or event["Records"][0]["s3"]["object"].get("eTag")
+    cached_payload = get_cached_result(etag=cache_key)
+    if cached_payload is not None:
+        response = {
+            "statusCode": 200,
+            "body": orjson.dumps(
+                {
+                    "insertedRows": cached_payload,
+                }
+            ).decode(),
+        }
+        logger.info(f"Response: {response}")
+        return response
 
     # Extract blood result data from the Textract service
     document = prepare_document(bucket=bucket, key=key, version=version)
     extracted_text = extract_text(document=document)
     blood_result = parse_extracted_text(extracted_text=extracted_text)
 
-    # Insert extracted data to the Airtable
+    # Insert extracted data to the Airtable; cache only after a successful
+    # insert so a failed insert gets a fresh retry instead of a cache hit
     inserted_payload = insert_to_airtable(blood_result=blood_result)
+    cache_result(etag=cache_key, payload=inserted_payload)
 
     response = {
         "statusCode": 200,
-        "body": json.dumps(
+        "body": orjson.dumps(
             {
-                "insertedRows": f"{inserted_payload}",
+                "insertedRows": inserted_payload,
             }
-        ),
+        ).decode(),
     }
 
     logger.info(f"Response: {response}")
+    return response
 
 
-def get_version(bucket, key):
-    """Return version of the file"""
-    s3_client = boto3.client("s3")
-    try:
-        response = s3_client.get_object_attributes(
-            Bucket=bucket,
-            Key=key,
-            ObjectAttributes=["ETag"],
-        )
-        logger.info(
-            f"Successfully obtained object {key} details from the bucket {bucket}. Response: {response}"
-        )
-        return response["VersionId"]
-    except Exception as e:
-        print(e)
-        print(
-            f"Error getting object {key} from bucket {bucket}. Make sure they exist and your bucket is in the same region as this function."
-        )
-        raise e
+def extract_only_handler(event, context):
+    """Return blood result from the file uploaded to the S3 bucket
+
+    Same as lambda_handler but without the Airtable insert. Both entry
+    points live in this module so each function's package ships a single
+    copy of the code and shares the warm clients. The SAM template's
+    Handler field picks the entry point per function.
+    """
+    # Return details of the file uploded to the S3 bucket
+    bucket = event["Records"][0]["s3"]["bucket"]["name"]
+    key = unquote_plus(event["Records"][0]["s3"]["object"]["key"], encoding="utf-8")
+    version = event["Records"][0]["s3"]["object"].get("versionId")
+
+    # Extract blood result data from the Textract service
+    document = prepare_document(bucket=bucket, key=key, version=version)
+    extracted_text = extract_text(document=document)
+    blood_result = parse_extracted_text(extracted_text=extracted_text)
+
+    response = {
+        "statusCode": 200,
+        "body": orjson.dumps(
+            {
+                "bloodResult": blood_result,
+            }
+        ).decode(),
+    }
+
+    logger.info(f"Response: {response}")
+    return response
+
+
+def start_extraction_handler(event, context):
+    """Start async extraction of text from the file uploaded to the S3 bucket
+
+    Use this handler for multi-page documents: it only starts the Textract
+    job, so the invocation is not billed for the analysis itself. Textract
+    publishes the finished job to SNS, which triggers
+    process_extraction_handler.
+    """
+    # Return details of the file uploded to the S3 bucket
+    bucket = event["Records"][0]["s3"]["bucket"]["name"]
+    key = unquote_plus(event["Records"][0]["s3"]["object"]["key"], encoding="utf-8")
+    version = event["Records"][0]["s3"]["object"].get("versionId")
+
+    # Start the async Textract job and return without waiting for it
+    document = prepare_document(bucket=bucket, key=key, version=version)
+    job_id = start_document_analysis(document=document)
+
+    response = {
+        "statusCode": 200,
+        "body": orjson.dumps(
+            {
+                "jobId": job_id,
+            }
+        ).decode(),
+    }
+
+    logger.info(f"Response: {response}")
+    return response
+
+
+def process_extraction_handler(event, context):
+    """Return blood result for a finished Textract job published to SNS"""
+    message = orjson.loads(event["Records"][0]["Sns"]["Message"])
+    job_id = message["JobId"]
+    status = message["Status"]
+    if status != "SUCCEEDED":
+        raise Exception(f"Textract job {job_id} finished with status {status}.")
+
+    # Collect the finished job results and parse the blood result
+    extracted_text = get_extracted_text(job_id=job_id)
+    blood_result = parse_extracted_text(extracted_text=extracted_text)
+
+    # Insert extracted data to the Airtable
+    inserted_payload = insert_to_airtable(blood_result=blood_result)
+
+    response = {
+        "statusCode": 200,
+        "body": orjson.dumps(
+            {
+                "insertedRows": inserted_payload,
+            }
+        ).decode(),
+    }
+
+    logger.info(f"Response: {response}")
+    return response
 
 
 def prepare_document(bucket, key, version):
     """Prepare and return document dict for Textract"""
-    return {
-        "S3Object": {
-            "Bucket": bucket,
-            "Name": key,
-            "Version": version,
-        }
+    s3_object = {
+        "Bucket": bucket,
+        "Name": key,
     }
+    # The version is only present when bucket versioning is enabled
+    if version:
+        s3_object["Version"] = version
+    return {"S3Object": s3_object}
 
 
 def extract_text(document):
     """Extract and return text from document using the Textract service"""
-    textract_client = boto3.client("textract")
-    print(document)
     try:
-        response = textract_client.analyze_document(
+        response = TEXTRACT_CLIENT.analyze_document(
             Document=document, FeatureTypes=["TABLES"]
         )
         logger.info(f"Successfully extracted text from the Textract service.")
         return response
-    except Exception as e:
-        print(e)
-        print(f"Error getting extracted text for the document {document}.")
-        raise e
+    except Exception:
+        logger.exception("Error getting extracted text for the document %s.", document)
+        raise
+
+
+def start_document_analysis(document):
+    """Start async text extraction of document using the Textract service"""
+    try:
+        response = TEXTRACT_CLIENT.start_document_analysis(
+            DocumentLocation=document,
+            FeatureTypes=["TABLES"],
+            NotificationChannel={
+                "SNSTopicArn": SNS_TOPIC_ARN,
+                "RoleArn": TEXTRACT_ROLE_ARN,
+            },
+        )
+        logger.info(f"Successfully started Textract job {response['JobId']}.")
+        return response["JobId"]
+    except Exception:
+        logger.exception(
+            "Error starting text extraction for the document %s.", document
+        )
+        raise
+
+
+def get_extracted_text(job_id):
+    """Collect and return extracted text of a finished Textract job"""
+    blocks = []
+    try:
+        future = EXECUTOR.submit(TEXTRACT_CLIENT.get_document_analysis, JobId=job_id)
+        while future:
+            response = future.result()
+
+            # Prefetch the next result page while this one is being collected
+            next_token = response.get("NextToken")
+            future = (
+                EXECUTOR.submit(
+                    TEXTRACT_CLIENT.get_document_analysis,
+                    JobId=job_id,
+                    NextToken=next_token,
+                )
+                if next_token
+                else None
+            )
+
+            blocks.extend(response["Blocks"])
+        logger.info(f"Successfully fetched extracted text for the job {job_id}.")
+        return {"Blocks": blocks}
+    except Exception:
+        logger.exception("Error getting extracted text for the job %s.", job_id)
+        raise
 
 
 def parse_extracted_text(extracted_text):
     """Parse and return extracted blood result"""
     blood_result = {}
 
-    for test in morphology:
-        # Find index of a block containing result for a test in morphology
-        index = next(
-            (
-                index
-                for (index, d) in enumerate(extracted_text["Blocks"])
-                if d.get("Text") and test in d.get("Text")
-            ),
-            None,
-        )
+    # Only LINE blocks carry the test names and values at the top level
+    # (CELL blocks reference their text through child WORD relationships),
+    # so drop everything else before searching
+    cells = [
+        block["Text"]
+        for block in extracted_text["Blocks"]
+        if block.get("BlockType") == "LINE" and block.get("Text")
+    ]
 
-        # Find the following block to get value for the test
-        next_block_index = index + 1
-        next_block = extracted_text["Blocks"][next_block_index]["Text"]
-
-        # Trim invalied characters of the next_block
-        if (
-            test
-            in (
-                "BASO",
-                "NEU%",
-                "LYMPH%",
-                "MON%",
-                "EOS%",
-            )
-            and next_block.find(" ") != -1  # Prevent from trimming an actual value
-        ):
-            next_block = next_block[0 : next_block.find(" ")]
+    # Resolve all tests in one pass over the cells, stopping as soon as every
+    # test in morphology has been found
+    remaining = set(morphology)
+    for index, text in enumerate(cells):
+        if not remaining:
+            break
+
+        # The value lives in the following cell, so a match on the last
+        # cell has nothing to read
+        if index + 1 == len(cells):
+            break
+        # Check the most specific test names first so a "NEU%" cell is
+        # claimed by "NEU%" rather than "NEU"; iterating the set directly
+        # would pick the winner based on the per-process hash seed
+        for test in sorted(remaining, key=lambda test: (-len(test), test)):
+            if test not in text:
+                continue
+
+            # The following cell holds the value for the test
+            next_block = cells[index + 1]
 
-        for element in ["^", "/", "%", "fl", "pg"]:
-            if element in next_block:
+            # Trim invalied characters of the next_block
+            if (
+                test in _PCT_TESTS
+                and next_block.find(" ") != -1  # Prevent from trimming an actual value
+            ):
                 next_block = next_block[0 : next_block.find(" ")]
-                break
 
-        blood_result[test] = next_block
+            if _TRIM_RE.search(next_block):
+                next_block = next_block[0 : next_block.find(" ")]
+
+            blood_result[test] = next_block
+            remaining.discard(test)
+            break
     return blood_result
 
 
+def get_cached_result(etag):
+    """Return cached inserted payload for the object etag, or None on a miss"""
+    if not CACHE_TABLE or not etag:
+        return None
+    try:
+        item = DDB_CLIENT.get_item(
+            TableName=CACHE_TABLE, Key={"etag": {"S": etag}}
+        ).get("Item")
+    except Exception:
+        logger.exception("Error reading cached payload for the etag %s.", etag)
+        return None
+    if not item:
+        return None
+    logger.info(f"Found cached payload for the etag {etag}.")
+    return orjson.loads(item["result"]["S"])
+
+
+def cache_result(etag, payload):
+    """Cache inserted Airtable payload under the object etag"""
+    if not CACHE_TABLE or not etag:
+        return
+    try:
+        DDB_CLIENT.put_item(
+            TableName=CACHE_TABLE,
+            Item={
+                "etag": {"S": etag},
+                "result": {"S": orjson.dumps(payload).decode()},
+            },
+        )
+    except Exception:
+        # A cache write failure must not fail the whole pipeline
+        logger.exception("Error caching payload for the etag %s.", etag)
+
+
+def _get_airtable_session():
+    """Return the shared Airtable HTTP session, creating it on first use"""
+    global AIRTABLE_SESSION
+    if AIRTABLE_SESSION is None:
+        import requests
+
+        AIRTABLE_SESSION = requests.Session()
+        AIRTABLE_SESSION.mount(
+            "https://",
+            requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4),
+        )
+    return AIRTABLE_SESSION
+
+
 def insert_to_airtable(blood_result):
     """Insert blood result into the Airtable table"""
-    access_token = os.getenv("AIRTABLE_ACCESS_KEY")
-    base_id = os.getenv("BASE_ID")
-    table_id = os.getenv("TABLE_ID")
-    url = f"https://api.airtable.com/v0/{base_id}/{table_id}"
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json",
-    }
+    import datetime
 
     # Format values of blood result for the airtable insert
-    for k, v in blood_result.items():
-        v = v.replace(",", ".")
-        blood_result[k] = float(v)
+    blood_result = {k: float(v.translate(_DEC)) for k, v in blood_result.items()}
 
     # Prepare payload for the airtable insert
-    current_date = datetime.datetime.now()
-    formatted_date = current_date.strftime("%Y-%m-%d")
-    fields = {"date": formatted_date}
-    fields.update(blood_result)
-    payload = {"records": [{"fields": fields}]}
+    payload = {
+        "records": [
+            {"fields": {"date": datetime.date.today().isoformat(), **blood_result}}
+        ]
+    }
 
     try:
-        response = requests.post(url=url, headers=headers, json=payload)
-        logger.info(
-            f"Successfully inserted payload: {payload} into the Airtable table."
+        response = _get_airtable_session().post(
+            url=AIRTABLE_URL,
+            headers=AIRTABLE_HEADERS,
+            data=orjson.dumps(payload),
+            timeout=10,
         )
-    except Exception as e:
-        print(e)
-        print(f"Error inserting payload {payload} into the Airtable table.")
-        raise e
+        logger.info("Successfully inserted payload into the Airtable table.")
+        logger.debug("Payload: %s", payload)
+    except Exception:
+        logger.exception("Error inserting payload %s into the Airtable table.", payload)
+        raise
 
     return payload